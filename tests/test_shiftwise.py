@@ -0,0 +1,102 @@
+"""Tests for ShiftWiseConv reparameterization and BottleneckSW dispatch."""
+
+import copy
+import pickle
+
+import pytest
+
+torch = pytest.importorskip("torch")
+nn = torch.nn
+
+from yolo12_shiftwise.modules.block import BottleneckSW, BottleneckSWAdd, BottleneckSWNoAdd  # noqa: E402
+from yolo12_shiftwise.modules.shiftwise import ShiftWiseConv  # noqa: E402
+
+
+def _randomize_bn(bn: nn.BatchNorm2d) -> None:
+    """給 BN 非平凡的統計量與仿射參數，確保摺疊真的有被驗證"""
+    with torch.no_grad():
+        bn.running_mean.uniform_(-0.5, 0.5)
+        bn.running_var.uniform_(0.5, 1.5)
+        bn.weight.uniform_(0.5, 1.5)
+        bn.bias.uniform_(-0.5, 0.5)
+
+
+def test_fuse_preserves_eval_output(monkeypatch):
+    """Fallback path: eval output is unchanged by fuse()."""
+    monkeypatch.setenv("SHIFTWISE_DISABLE", "1")
+    torch.manual_seed(0)
+    m = ShiftWiseConv(8, 8, big_k=13)
+    _randomize_bn(m.fallback_bn)
+    m.eval()
+
+    x = torch.randn(2, 8, 16, 16)
+    with torch.no_grad():
+        before = m(x)
+        m.fuse()
+        after = m(x)
+
+    assert m._fused
+    torch.testing.assert_close(after, before, rtol=1e-4, atol=1e-5)
+
+
+def test_fuse_skips_configured_shiftwise_path(monkeypatch):
+    """fuse() before the first forward must not replace a configured ShiftWise path with the fallback conv."""
+    monkeypatch.setenv("SHIFTWISE_DISABLE", "1")
+    m = ShiftWiseConv(8, 8, big_k=13)
+    # 模擬 AddShift 可用、但 shift 尚未延遲初始化的狀態（ultralytics 載入權重後立即 fuse）
+    m.use_shiftwise = True
+    m.channel_expand = nn.Conv2d(8, 8 * 5, 1, bias=False)
+    m.shift_bn = nn.BatchNorm2d(8)
+    m.eval()
+
+    m.fuse()
+
+    assert not m._fused
+    assert m.channel_expand is not None
+    assert hasattr(m, "fallback_conv")
+
+
+@pytest.mark.parametrize(
+    "c1, c2, shortcut, expected",
+    [
+        (8, 8, True, BottleneckSWAdd),
+        (8, 8, False, BottleneckSWNoAdd),
+        (8, 16, True, BottleneckSWNoAdd),
+    ],
+)
+def test_bottleneck_dispatch(monkeypatch, c1, c2, shortcut, expected):
+    """BottleneckSW(...) picks the residual/no-residual subclass and matches the reference forward."""
+    monkeypatch.setenv("SHIFTWISE_DISABLE", "1")
+    torch.manual_seed(0)
+    m = BottleneckSW(c1, c2, shortcut, e=1.0, replace_both=True).eval()
+    assert type(m) is expected
+
+    x = torch.randn(2, c1, 16, 16)
+    with torch.no_grad():
+        y = m.cv2(m.cv1(x))
+        ref = x + y if expected is BottleneckSWAdd else y
+        torch.testing.assert_close(m(x), ref)
+
+
+def test_bottleneck_copy_keeps_class(monkeypatch):
+    """deepcopy and pickle round-trips keep the dispatched subclass."""
+    monkeypatch.setenv("SHIFTWISE_DISABLE", "1")
+    for shortcut, expected in ((True, BottleneckSWAdd), (False, BottleneckSWNoAdd)):
+        m = BottleneckSW(8, 8, shortcut, e=1.0, replace_both=True)
+        assert type(copy.deepcopy(m)) is expected
+        assert type(pickle.loads(pickle.dumps(m))) is expected
+
+
+def test_bottleneck_loads_legacy_pickle(monkeypatch):
+    """Pickles of a plain BottleneckSW (before the subclass dispatch) still load and run."""
+    monkeypatch.setenv("SHIFTWISE_DISABLE", "1")
+    torch.manual_seed(0)
+    m = BottleneckSW(8, 8, True, e=1.0, replace_both=True).eval()
+    # 舊版 checkpoint 的物件類別就是 BottleneckSW 本身，forward 依 self.add 分支
+    m.__class__ = BottleneckSW
+    restored = pickle.loads(pickle.dumps(m))
+    assert type(restored) is BottleneckSW
+
+    x = torch.randn(2, 8, 16, 16)
+    with torch.no_grad():
+        torch.testing.assert_close(restored(x), x + restored.cv2(restored.cv1(x)))
@@ -11,8 +11,9 @@ Usage:
     model = YOLO("yolo12s_shiftwise.yaml")
 """
 
+from .inference import compile, fx_trace, quantize_int8, script
 from .patches import apply_shiftwise_patch
 
 __version__ = "0.1.0"
-__all__ = ["apply_shiftwise_patch"]
+__all__ = ["apply_shiftwise_patch", "compile", "fx_trace", "quantize_int8", "script"]
 
@@ -0,0 +1,204 @@
+"""Inference-time optimizations for models built with ShiftWise modules."""
+
+from __future__ import annotations
+
+import itertools
+from typing import Iterable
+
+import torch
+import torch.fx
+import torch.nn as nn
+
+from .modules import BottleneckSW, ShiftWiseConv
+
+
+class ShiftWiseTracer(torch.fx.Tracer):
+    """FX tracer that keeps C3k2_SW, BottleneckSW and ShiftWiseConv as opaque leaf modules.
+
+    ShiftWiseConv's forward branches on tensor properties (device, AddShift availability),
+    which symbolic tracing cannot follow. Treating the ShiftWise modules as leaves keeps them
+    as single ``call_module`` nodes while the rest of the graph stays open to FX passes.
+
+    Args:
+        leaf_modules: Extra module types to treat as leaves (e.g. ultralytics ``C3k2``,
+            ``A2C2f`` and ``Detect``)
+    """
+
+    def __init__(self, leaf_modules: tuple = (), **kwargs):
+        from .modules import C3k2_SW
+
+        super().__init__(**kwargs)
+        self.leaf_modules = (C3k2_SW, BottleneckSW, ShiftWiseConv, *leaf_modules)
+
+    def is_leaf_module(self, m: nn.Module, module_qualified_name: str) -> bool:
+        """Return True for ShiftWise modules, the extra leaf types, and torch.nn built-ins."""
+        return isinstance(m, self.leaf_modules) or super().is_leaf_module(m, module_qualified_name)
+
+
+def _script_block(block: nn.Module, freeze: bool = False) -> nn.Module:
+    """TorchScript 編譯單一 bottleneck，失敗時（例如 ShiftWiseConv 的動態路徑）保留 eager 版本"""
+    try:
+        scripted = torch.jit.script(block)
+        if freeze and not block.training:
+            # freeze 後權重變常數，optimize_for_inference 才能做 conv+add+act 等圖融合
+            scripted = torch.jit.optimize_for_inference(torch.jit.freeze(scripted))
+        return scripted
+    except Exception:
+        return block
+
+
+def _replace_blocks(model: nn.Module, fn) -> nn.Module:
+    """將模型中每個 C3k2_SW 的 BottleneckSW 以 fn(block) 的結果取代"""
+    from .modules import C3k2_SW
+
+    stages = [m for m in model.modules() if isinstance(m, C3k2_SW)]
+    for stage in stages:
+        for i, block in enumerate(stage.m):
+            if isinstance(block, BottleneckSW):
+                stage.m[i] = fn(block)
+    return model
+
+
+def _batch_input(batch):
+    """從 calibration batch 取出模型輸入（tensor，或第一個元素為輸入的 tuple/list）"""
+    return batch[0] if isinstance(batch, (list, tuple)) else batch
+
+
+def _is_reparameterized(block: nn.Module) -> bool:
+    """block 內所有 ShiftWiseConv 是否都已重參數化為單一卷積（FX 才能 trace）"""
+    return all(getattr(m, "_fused", False) for m in block.modules() if isinstance(m, ShiftWiseConv))
+
+
+def compile(model: nn.Module, mode: str = "reduce-overhead") -> nn.Module:
+    """Compile every BottleneckSW inside the model's C3k2_SW stages in place.
+
+    Each bottleneck is compiled on its own rather than the whole model, which keeps
+    recompilation bounded when input shapes change across FPN scales. On torch < 2.1 this
+    falls back to ``script`` without freezing, so the model can still be moved and saved.
+    Call ``model.fuse()`` first so the ShiftWiseConv layers are reparameterized into plain
+    convolutions.
+
+    Args:
+        model: Model containing C3k2_SW stages (e.g. ``YOLO(...).model``)
+        mode: ``torch.compile`` mode
+
+    Returns:
+        The same model with its bottlenecks replaced by compiled modules.
+    """
+    if torch.__version__ < "2.1":
+        return script(model)
+    return _replace_blocks(model, lambda block: torch.compile(block, mode=mode, dynamic=False, fullgraph=False))
+
+
+def script(model: nn.Module, freeze: bool = False) -> nn.Module:
+    """Script every BottleneckSW inside the model's C3k2_SW stages with TorchScript in place.
+
+    Blocks that cannot be scripted (a ShiftWiseConv that was not reparameterized) stay eager.
+    Call ``model.fuse()`` first.
+
+    With ``freeze=True``, blocks in eval mode are also frozen and passed through
+    ``torch.jit.optimize_for_inference``, which lets the JIT fuse the residual add with the
+    preceding conv. Freezing turns the weights into graph constants (possibly MKLDNN on CPU):
+    they leave ``state_dict()`` and no longer follow ``.to()``/``.half()``/``.float()``. Only
+    freeze after the final device and dtype move, and do not save the result.
+
+    Args:
+        model: Model containing C3k2_SW stages (e.g. ``YOLO(...).model``)
+        freeze: Freeze and optimize eval-mode blocks for inference
+
+    Returns:
+        The same model with its bottlenecks replaced by ScriptModules where possible.
+    """
+    return _replace_blocks(model, lambda block: _script_block(block, freeze))
+
+
+def quantize_int8(model: nn.Module, calibration_loader: Iterable, backend: str = "x86") -> nn.Module:
+    """Apply post-training int8 quantization to the ShiftWise bottlenecks with torch FX.
+
+    The C3k2_SW stages are fused first, so every ShiftWiseConv collapses into a plain conv.
+    Each BottleneckSW is then prepared separately with ``prepare_fx``. FX adds
+    quantize/dequantize at the block boundaries, and the rest of the model, including the
+    Detect head, stays in float. Blocks that still use the AddShift CUDA kernel are skipped.
+    Quantized kernels run on CPU; requires torch >= 1.13.
+
+    Args:
+        model: Model containing C3k2_SW stages on CPU (e.g. ``YOLO(...).model``)
+        calibration_loader: Iterable of float input batches (tensors, or tuples/lists whose
+            first item is the input)
+        backend: Quantization backend passed to ``get_default_qconfig_mapping``
+
+    Returns:
+        The same model with its bottlenecks replaced by quantized GraphModules.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    from .modules import C3k2_SW
+
+    model.eval()
+    stages = [m for m in model.modules() if isinstance(m, C3k2_SW)]
+    for stage in stages:
+        stage.fuse()
+    targets = [
+        (stage, i)
+        for stage in stages
+        for i, block in enumerate(stage.m)
+        if isinstance(block, BottleneckSW) and _is_reparameterized(block)
+    ]
+
+    # prepare_fx 需要每個 block 的 example inputs，用第一個 batch 跑一次 forward 擷取
+    batches = iter(calibration_loader)
+    try:
+        first = next(batches)
+    except StopIteration:
+        raise ValueError("calibration_loader is empty") from None
+    example_inputs = {}
+
+    def _record_inputs(m, args):
+        # pre-hook 回傳非 None 會被當成替換後的輸入，這裡只記錄、不回傳
+        example_inputs.setdefault(m, args)
+
+    handles = [stage.m[i].register_forward_pre_hook(_record_inputs) for stage, i in targets]
+    try:
+        with torch.no_grad():
+            model(_batch_input(first))
+    finally:
+        for h in handles:
+            h.remove()
+
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    prepared = []
+    for stage, i in targets:
+        block = stage.m[i]
+        if block in example_inputs:
+            stage.m[i] = prepare_fx(block, qconfig_mapping, example_inputs[block])
+            prepared.append((stage, i))
+
+    # 校正：observers 收集 activation 範圍
+    with torch.no_grad():
+        for batch in itertools.chain([first], batches):
+            model(_batch_input(batch))
+
+    for stage, i in prepared:
+        stage.m[i] = convert_fx(stage.m[i])
+    return model
+
+
+def fx_trace(model: nn.Module, leaf_modules: tuple = ()) -> torch.fx.GraphModule:
+    """Symbolically trace a model with ShiftWise modules kept as leaves.
+
+    The returned GraphModule can go through ``torch.fx.passes`` or FX quantization. Stock
+    ultralytics modules that iterate or branch on tensors must be passed in ``leaf_modules``
+    too: ``C3k2`` (``list(chunk)``), ``A2C2f`` (unpacks ``x.shape`` in its attention) and the
+    ``Detect`` head.
+
+    Args:
+        model: Model to trace (e.g. ``YOLO(...).model``)
+        leaf_modules: Extra module types to keep as leaves
+
+    Returns:
+        A GraphModule equivalent to ``model``.
+    """
+    tracer = ShiftWiseTracer(leaf_modules)
+    graph = tracer.trace(model)
+    return torch.fx.GraphModule(tracer.root, graph, model.__class__.__name__)
@@ -1,7 +1,15 @@
 """ShiftWise modules for YOLO."""
 
-from .block import BottleneckSW, C3k2_SW
+from .block import BottleneckSW
 from .shiftwise import ShiftWiseConv
 
 __all__ = ["ShiftWiseConv", "BottleneckSW", "C3k2_SW"]
 
+
+def __getattr__(name: str):
+    """C3k2_SW 延遲定義（需要 ultralytics），見 block.__getattr__"""
+    if name == "C3k2_SW":
+        from .block import C3k2_SW
+
+        return C3k2_SW
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
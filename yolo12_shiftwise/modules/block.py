@@ -5,6 +5,33 @@ from __future__ import annotations
 import torch
 import torch.nn as nn
 
+from .shiftwise import ShiftWiseConv, _fold_bn, _ScratchBuffer
+
+# ultralytics 基礎模組（延遲導入避免循環依賴），由 _import_ultralytics() 快取一次
+_ULT_CONV = None
+_ULT_C2F = None
+_ULT_C3K = None
+
+
+def _import_ultralytics() -> None:
+    """導入並快取 ultralytics 的 Conv/C2f/C3k，之後建構模組時只需讀取模組層級變數"""
+    global _ULT_CONV, _ULT_C2F, _ULT_C3K
+    if _ULT_CONV is None:
+        from ultralytics.nn.modules.block import C2f, C3k
+        from ultralytics.nn.modules.conv import Conv
+
+        _ULT_CONV, _ULT_C2F, _ULT_C3K = Conv, C2f, C3k
+
+
+def _fuse_conv(m: nn.Module) -> None:
+    """摺疊單層卷積的 BN：ShiftWiseConv 走自己的 fuse，ultralytics Conv 比照 BaseModel.fuse 處理"""
+    if isinstance(m, ShiftWiseConv):
+        m.fuse()
+    elif isinstance(getattr(m, "conv", None), nn.Conv2d) and isinstance(getattr(m, "bn", None), nn.BatchNorm2d):
+        _fold_bn(m.conv, m.bn)
+        delattr(m, "bn")
+        m.forward = m.forward_fuse
+
 
 class BottleneckSW(nn.Module):
     """Bottleneck variant that uses ShiftWiseConv for large receptive field.
@@ -21,46 +48,82 @@ class BottleneckSW(nn.Module):
         big_k: Equivalent large kernel size for ShiftWise (must be >> 3)
         replace_both: If True, replace both cv1 and cv2 with ShiftWiseConv.
                      If False, only replace cv2 (backward compatibility).
+        scratch: Optional scratch buffer shared by the ShiftWiseConv layers of a stage
     """
 
+    def __new__(cls, c1: int | None = None, c2: int | None = None, shortcut: bool = True, *args, **kwargs):
+        """Dispatch to BottleneckSWAdd or BottleneckSWNoAdd so forward has no runtime branch."""
+        # 不帶參數（pickle / deepcopy 還原）時保留原類別，舊 checkpoint 仍走 self.add 分支
+        if cls is BottleneckSW and c1 is not None:
+            cls = BottleneckSWAdd if shortcut and c1 == c2 else BottleneckSWNoAdd
+        return super().__new__(cls)
+
     def __init__(
-        self, c1: int, c2: int, shortcut: bool = True, e: float = 0.5, big_k: int = 13, replace_both: bool = True
+        self,
+        c1: int,
+        c2: int,
+        shortcut: bool = True,
+        e: float = 0.5,
+        big_k: int = 13,
+        replace_both: bool = True,
+        scratch: _ScratchBuffer | None = None,
     ):
         """Initialize a ShiftWise bottleneck with configurable big_k."""
         super().__init__()
-        
-        # 動態導入（避免循環依賴）
-        from ultralytics.nn.modules.conv import Conv
-        from .shiftwise import ShiftWiseConv
-        
         c_ = int(c2 * e)
         
         if replace_both:
             # Replace both layers with ShiftWiseConv (target architecture)
-            self.cv1 = ShiftWiseConv(c1, c_, big_k=big_k, small_k=3, s=1)
-            self.cv2 = ShiftWiseConv(c_, c2, big_k=big_k, small_k=3, s=1)
+            self.cv1 = ShiftWiseConv(c1, c_, big_k=big_k, small_k=3, s=1, scratch=scratch)
+            self.cv2 = ShiftWiseConv(c_, c2, big_k=big_k, small_k=3, s=1, scratch=scratch)
         else:
             # Only replace cv2 (backward compatibility)
-            self.cv1 = Conv(c1, c_, 1, 1)
-            self.cv2 = ShiftWiseConv(c_, c2, big_k=big_k, small_k=3, s=1)
+            if _ULT_CONV is None:
+                _import_ultralytics()
+            self.cv1 = _ULT_CONV(c1, c_, 1, 1)
+            self.cv2 = ShiftWiseConv(c_, c2, big_k=big_k, small_k=3, s=1, scratch=scratch)
         
         self.add = shortcut and c1 == c2
+        self._fused = False
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         """Forward pass of the ShiftWise bottleneck."""
         y = self.cv2(self.cv1(x))
         return x + y if self.add else y
 
+    def fuse(self) -> "BottleneckSW":
+        """Fold BatchNorm into the preceding convolutions of cv1 and cv2 for inference (idempotent)."""
+        if getattr(self, "_fused", False):
+            return self
+        _fuse_conv(self.cv1)
+        _fuse_conv(self.cv2)
+        self._fused = True
+        return self
 
-def _create_c3k2_sw_class():
-    """動態創建 C3k2_SW 類，繼承自 C2f（避免循環依賴）"""
-    from ultralytics.nn.modules.block import C2f, C3k
-    
-    # 在閉包中捕獲模組級別的 BottleneckSW（避免循環依賴）
-    # BottleneckSW 在模組級別定義，所以可以在閉包中訪問
-    _BottleneckSW = BottleneckSW  # 捕獲模組級別的 BottleneckSW
+
+class BottleneckSWAdd(BottleneckSW):
+    """BottleneckSW with the residual connection (shortcut and c1 == c2)."""
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """Forward pass with an unconditional residual add."""
+        return x + self.cv2(self.cv1(x))
+
+
+class BottleneckSWNoAdd(BottleneckSW):
+    """BottleneckSW without the residual connection."""
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """Forward pass without the residual add."""
+        return self.cv2(self.cv1(x))
+
+
+def _define_c3k2_sw():
+    """定義 C3k2_SW 類，繼承自 C2f（第一次存取時才導入 ultralytics，避免循環依賴）"""
+    # 宣告為 global：類別直接綁定到模組層級，__qualname__ 為 "C3k2_SW"，pickle 可正常還原
+    global C3k2_SW
+    _import_ultralytics()
     
-    class C3k2_SW(C2f):
+    class C3k2_SW(_ULT_C2F):
         """C3k2 variant backed by ShiftWise bottlenecks with configurable big_k.
         
         This module allows per-stage configuration of big_k (equivalent large kernel size)
@@ -92,55 +155,84 @@ def _create_c3k2_sw_class():
             replace_both: bool = True,
         ):
             """Initialize ShiftWise-enabled C3k2 module with configurable big_k."""
-            # 調試：打印接收到的參數（僅第一次）
-            if not hasattr(C3k2_SW, '_debug_printed'):
-                print(f"DEBUG C3k2_SW.__init__ received: c1={c1} (type={type(c1)}), c2={c2} (type={type(c2)}), n={n} (type={type(n)}), c3k={c3k}, e={e} (type={type(e)}), g={g} (type={type(g)}), shortcut={shortcut} (type={type(shortcut)})")
-                C3k2_SW._debug_printed = True
-            
-            # 直接調用父類 C2f 的 __init__，與可運行的版本保持一致
-            # C2f 的參數順序是: (c1, c2, n, shortcut, g, e)
-            # 確保所有參數都是正確的類型
-            c1 = int(c1)
-            c2 = int(c2)
-            n = int(n)
-            shortcut = bool(shortcut)
-            g = int(g)
-            e = float(e)
-            
+            # parse_model 已將 YAML args 展開為純量（c1 取自 ch[f]、c2 經 make_divisible、n 由 repeat_modules 插入），
+            # 直接以 C2f 的參數順序 (c1, c2, n, shortcut, g, e) 調用父類
             super().__init__(c1, c2, n, shortcut, g, e)
             
             # 替換 m 為 ShiftWise 版本
             if c3k:
-                block = C3k
+                block = _ULT_C3K
                 self.m = nn.ModuleList(block(self.c, self.c, 2, shortcut, g) for _ in range(n))
             else:
                 # Use BottleneckSW with configurable big_k
-                # 使用閉包中捕獲的 _BottleneckSW（避免循環依賴和 sys.modules 問題）
+                # 同一 stage 的 ShiftWiseConv 依序執行，推論時可共用一份暫存
+                self._sw_scratch = _ScratchBuffer()
                 self.m = nn.ModuleList(
-                    _BottleneckSW(self.c, self.c, shortcut, e=1.0, big_k=big_k, replace_both=replace_both)
+                    BottleneckSW(
+                        self.c,
+                        self.c,
+                        shortcut,
+                        e=1.0,
+                        big_k=big_k,
+                        replace_both=replace_both,
+                        scratch=self._sw_scratch,
+                    )
                     for _ in range(n)
                 )
+            self._fused = False
+            self._channels_last = False
+
+        def forward(self, x: torch.Tensor) -> torch.Tensor:
+            """Forward pass; keeps the stage in channels_last end to end when enabled."""
+            channels_last = self._channels_last
+            # 只在 stage 入口轉換一次，bottleneck 內的卷積輸出會沿用相同的 memory format；
+            # 已是 channels_last 時 contiguous 直接回傳原張量，不需先檢查（也讓 FX 可以 trace）
+            if channels_last:
+                x = x.contiguous(memory_format=torch.channels_last)
+            a, b = self.cv1(x).split((self.c, self.c), 1)
+            y = [a, b]
+            for m in self.m:
+                y.append(m(y[-1]))
+            # split 出來的 view 保有 channels_last 的 stride 順序，cat 會據此輸出 channels_last，不需另外複製
+            y = torch.cat(y, 1)
+            # FX trace 時 y 是 Proxy，layout 檢查只在實際執行時做
+            assert not (channels_last and isinstance(y, torch.Tensor)) or y.is_contiguous(
+                memory_format=torch.channels_last
+            )
+            return self.cv2(y)
+
+        def _sync_memory_format(self) -> None:
+            """Switch weights to channels_last when they live on CUDA.
+
+            Skipped while any ShiftWiseConv uses the AddShift kernel, which requires NCHW
+            and would reorder every input back.
+            """
+            p = next(self.parameters(), None)
+            self._channels_last = (
+                p is not None
+                and p.is_cuda
+                and not any(isinstance(m, ShiftWiseConv) and m.use_shiftwise for m in self.modules())
+            )
+            if self._channels_last:
+                self.to(memory_format=torch.channels_last)
+
+        def fuse(self) -> "C3k2_SW":
+            """Fold BatchNorm into cv1/cv2 and every ShiftWise bottleneck for inference (idempotent)."""
+            if getattr(self, "_fused", False):
+                return self
+            _fuse_conv(self.cv1)
+            _fuse_conv(self.cv2)
+            for m in self.m:
+                if isinstance(m, BottleneckSW):
+                    m.fuse()
+            self._fused = True
+            return self
     
     return C3k2_SW
 
 
-# 延遲創建類（在第一次使用時）
-_C3k2_SW_class = None
-
-
-def get_c3k2_sw_class():
-    """獲取 C3k2_SW 類（延遲加載）"""
-    global _C3k2_SW_class
-    if _C3k2_SW_class is None:
-        _C3k2_SW_class = _create_c3k2_sw_class()
-    return _C3k2_SW_class
-
-
-# 為了向後相容，創建一個代理類
-class C3k2_SW:
-    """代理類，延遲加載實際的 C3k2_SW 實現"""
-    
-    def __new__(cls, *args, **kwargs):
-        actual_class = get_c3k2_sw_class()
-        return actual_class(*args, **kwargs)
-
+def __getattr__(name: str):
+    """第一次存取 C3k2_SW 時才定義它（apply_shiftwise_patch 與 pickle 還原都會觸發）"""
+    if name == "C3k2_SW":
+        return _define_c3k2_sw()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
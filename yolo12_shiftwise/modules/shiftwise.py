@@ -2,8 +2,12 @@
 
 from __future__ import annotations
 
+import math
+import os
+
 import torch
 import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_weights
 
 # 嘗試載入 ShiftWise CUDA 模組（模組層級檢查）
 try:
@@ -35,6 +39,39 @@ def _check_shiftwise_available():
         return False, None
 
 
+def _fold_bn(conv: nn.Conv2d, bn: nn.BatchNorm2d) -> None:
+    """將 BatchNorm 的 running statistics 摺疊進前一層 Conv2d 的 weight/bias（in-place）"""
+    conv.weight, conv.bias = fuse_conv_bn_weights(
+        conv.weight, conv.bias, bn.running_mean, bn.running_var, bn.eps, bn.weight, bn.bias
+    )
+
+
+class _ScratchBuffer:
+    """推論時同一個 C3k2_SW 內所有 ShiftWiseConv 共用的暫存張量（以 resize_ 重複使用，不每次配置）
+
+    以 device 為 key 各存一份：DataParallel 的 replica 會淺複製 __dict__、共用同一個 holder，
+    各 GPU 的執行緒只會讀寫自己 device 的那份，不會互相覆寫
+    """
+
+    def __init__(self):
+        self.tensors = {}
+
+    def get(self, shape: torch.Size, like: torch.Tensor) -> torch.Tensor:
+        """取得 like 所在 device 上指定形狀的暫存張量，dtype 或 inference mode 不符時才重新配置"""
+        t = self.tensors.get(like.device)
+        if t is None or t.dtype != like.dtype or t.is_inference() != torch.is_inference_mode_enabled():
+            t = self.tensors[like.device] = torch.empty(0, device=like.device, dtype=like.dtype)
+        return t.resize_(shape)
+
+    def __getstate__(self):
+        # 暫存內容不需保存（pickle / deepcopy 時丟棄）
+        return {}
+
+    def __setstate__(self, state):
+        # 舊版保存的是單一 tensor 欄位，一律從空的 per-device 暫存開始
+        self.tensors = {}
+
+
 class ShiftWiseConv(nn.Module):
     """ShiftWise convolution module following the paper's design.
     
@@ -48,10 +85,18 @@ class ShiftWiseConv(nn.Module):
         small_k: Small kernel size, fixed to 3 per paper requirement.
         s: Stride (currently only stride=1 is supported)
         act: Activation function
+        scratch: Optional scratch buffer shared across layers, used only when grad is disabled
     """
 
     def __init__(
-        self, c1: int, c2: int, big_k: int = 13, small_k: int = 3, s: int = 1, act: bool | nn.Module = True
+        self,
+        c1: int,
+        c2: int,
+        big_k: int = 13,
+        small_k: int = 3,
+        s: int = 1,
+        act: bool | nn.Module = True,
+        scratch: _ScratchBuffer | None = None,
     ):
         super().__init__()
         self.stride = s
@@ -75,9 +120,10 @@ class ShiftWiseConv(nn.Module):
         self._small_k = small_k
         self._c2 = c2
         self._c1 = c1
+        self._fused = False
+        self._scratch = scratch
 
         # 檢查環境變數：如果設置了 SHIFTWISE_DISABLE=1，完全禁用 ShiftWise
-        import os
         shiftwise_disabled = os.getenv("SHIFTWISE_DISABLE", "0") == "1"
         
         # 動態檢查 ShiftWise CUDA 模組是否可用（每次初始化時重新檢查）
@@ -90,7 +136,6 @@ class ShiftWiseConv(nn.Module):
         
         if self.use_shiftwise and shift_module is not None:
             # AddShift_mp_module 需要：c_in = c_out * nk，其中 nk = ceil(big_k / small_k)
-            import math
             nk = math.ceil(big_k / small_k)  # 對於 big_k=13, small_k=3: nk=5
             c_in_expanded = c2 * nk  # 擴展後的輸入通道數
             
@@ -114,6 +159,47 @@ class ShiftWiseConv(nn.Module):
             self._shift_module_class = None
             self._c_in_expanded = None
 
+    def reparameterize(self) -> None:
+        """Collapse the module into a single dense ``fused_conv`` with BN folded in (idempotent).
+
+        Only the fallback path is a plain big_k x big_k convolution. Whenever the ShiftWise path
+        is configured (``channel_expand``/``shift_bn`` hold the weights, even before the AddShift
+        kernel is lazily created on the first forward) its shift layout lives in the external
+        extension, so the module is left untouched in that case.
+        """
+        if getattr(self, "_fused", False):
+            return
+        # ultralytics 載入權重後會在第一次 forward 之前呼叫 fuse，此時 shift 仍是 None，
+        # 不能只看 shift；只要 ShiftWise 路徑已配置，fallback_conv 就不是訓練過的權重
+        if self.use_shiftwise and self.channel_expand is not None:
+            if not hasattr(self, '_reparam_warned'):
+                print("⚠️  ShiftWise CUDA 路徑已啟用，無法重參數化為單一卷積，保留原本結構")
+                self._reparam_warned = True
+            return
+
+        # fallback_conv 本身就是等效的 big_k x big_k 卷積，摺疊 BN 後直接沿用
+        _fold_bn(self.fallback_conv, self.fallback_bn)
+        self.fused_conv = self.fallback_conv
+        del self.fallback_conv, self.fallback_bn
+
+        # 未使用的 ShiftWise 分支一併移除，避免 forward 再去重新檢查 CUDA 模組
+        self.shift_bn = None
+        self.channel_expand = None
+        self._shift_module_class = None
+        self.use_shiftwise = False
+
+        self.forward = self.forward_fuse
+        self._fused = True
+
+    def fuse(self) -> "ShiftWiseConv":
+        """Reparameterize for inference, see ``reparameterize``."""
+        self.reparameterize()
+        return self
+
+    def forward_fuse(self, x: torch.Tensor) -> torch.Tensor:
+        """Forward pass of the reparameterized module (single dense convolution)."""
+        return self.act(self.fused_conv(x))
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         """Run shiftwise path when CUDA is available, otherwise fallback to standard conv."""
         # 重新檢查 ShiftWise 是否可用（可能在 __init__ 時不可用，但現在可用了）
@@ -122,7 +208,6 @@ class ShiftWiseConv(nn.Module):
             use_shiftwise_new, shift_module = _check_shiftwise_available()
             if use_shiftwise_new and shift_module is not None:
                 # 現在可用，設置參數
-                import math
                 nk = math.ceil(self._big_k / self._small_k)
                 c_in_expanded = self._c2 * nk
                 self._shift_module_class = shift_module
@@ -153,7 +238,6 @@ class ShiftWiseConv(nn.Module):
                     # 現在初始化 AddShift_mp_module
                     # 注意：AddShift_mp_module.__init__ 會調用 torch.manual_seed，可能觸發 CUDA 操作
                     # 使用 CUDA_LAUNCH_BLOCKING 來獲取更詳細的錯誤信息
-                    import os
                     old_blocking = os.environ.get("CUDA_LAUNCH_BLOCKING", "0")
                     os.environ["CUDA_LAUNCH_BLOCKING"] = "1"  # 臨時啟用以獲取詳細錯誤
                     
@@ -330,26 +414,41 @@ class ShiftWiseConv(nn.Module):
                 y2 = y2.contiguous() if not y2.is_contiguous() else y2
                 y3 = y3.contiguous() if not y3.is_contiguous() else y3
                 
-                result = y1 + y2 + y3
-                result = result.contiguous()  # 強制連續
+                # 維持 autocast 選定的激活 dtype（channel_expand 的輸出），避免 kernel 輸出 fp32 時
+                # 後續相加與 shift_bn 被悄悄升為 fp32、記憶體流量加倍
+                y1, y2, y3 = y1.to(x_expanded.dtype), y2.to(x_expanded.dtype), y3.to(x_expanded.dtype)
                 
                 # ShiftWise 輸出尺寸會比輸入小 2*extra_pad
                 # 但 YOLO 架構期望輸出尺寸等於輸入尺寸（stride=1, padding=k//2）
-                # 所以我們需要進行 padding 來恢復原始尺寸
-                if hout != h or wout != w:
-                    # 計算需要的 padding
-                    pad_h = (h - hout) // 2
-                    pad_w = (w - wout) // 2
-                    pad_h_remainder = (h - hout) % 2
-                    pad_w_remainder = (w - wout) % 2
+                # 所以需要補零恢復原始尺寸
+                scratch = getattr(self, "_scratch", None)
+                if scratch is not None and not torch.is_grad_enabled():
+                    # 推論時直接把 y1 + y2 + y3 寫進共用暫存（已補零的完整尺寸）的內部區域，
+                    # 省去相加後再 F.pad 的配置與複製；shift_bn 會產生新張量，暫存不會外流。
+                    # 暫存依 y1 的 device 取用，DataParallel 各 replica 不會搶同一塊記憶體
+                    result = scratch.get((b, y1.shape[1], h, w), y1).zero_()
+                    inner = result[:, :, extra_pad:extra_pad + hout, extra_pad:extra_pad + wout]
+                    torch.add(y1, y2, out=inner)
+                    inner += y3
+                else:
+                    # 訓練時維持一般配置（out= 不支援 autograd，也避免別名問題）
+                    result = y1 + y2 + y3
+                    result = result.contiguous()  # 強制連續
                     
-                    # 進行 padding：pad (left, right, top, bottom)
-                    result = torch.nn.functional.pad(
-                        result,
-                        (pad_w, pad_w + pad_w_remainder, pad_h, pad_h + pad_h_remainder),
-                        mode='constant',
-                        value=0
-                    )
+                    if hout != h or wout != w:
+                        # 計算需要的 padding
+                        pad_h = (h - hout) // 2
+                        pad_w = (w - wout) // 2
+                        pad_h_remainder = (h - hout) % 2
+                        pad_w_remainder = (w - wout) % 2
+                        
+                        # 進行 padding：pad (left, right, top, bottom)
+                        result = torch.nn.functional.pad(
+                            result,
+                            (pad_w, pad_w + pad_w_remainder, pad_h, pad_h + pad_h_remainder),
+                            mode='constant',
+                            value=0
+                        )
                 
                 # 同步 CUDA 操作以檢查是否有錯誤
                 torch.cuda.synchronize()
@@ -1,8 +1,51 @@
 """Patch ultralytics.nn.tasks to support ShiftWise modules."""
 
+import logging
 import sys
 from typing import Any
 
+LOGGER = logging.getLogger(__name__)
+
+# 已完整套用過 patch 的旗標（同一 process 內重複呼叫時直接返回）；任一步失敗則不設定，下次呼叫可重試
+_PATCH_APPLIED = False
+
+
+def _patch_fuse(tasks, fusable: tuple) -> None:
+    """包裝 BaseModel.fuse，在原本的 Conv+BN 融合之後再融合 ShiftWise 模組"""
+    original_fuse = tasks.BaseModel.fuse
+    if getattr(original_fuse, "_shiftwise_patched", False):
+        return
+
+    def fuse(self, *args, **kwargs):
+        # 先跑原本的 fuse：它依 BN 數量判斷 is_fused()，必須在我們移除 BN 之前執行
+        model = original_fuse(self, *args, **kwargs)
+        for m in self.modules():
+            if isinstance(m, fusable):
+                m.fuse()
+        return model
+
+    fuse._shiftwise_patched = True
+    fuse.__doc__ = original_fuse.__doc__
+    tasks.BaseModel.fuse = fuse
+
+
+def _patch_apply(tasks, c3k2_sw_class) -> None:
+    """包裝 BaseModel._apply，在 model.to()/cuda()/half() 之後把 C3k2_SW 切換為 channels_last"""
+    original_apply = tasks.BaseModel._apply
+    if getattr(original_apply, "_shiftwise_patched", False):
+        return
+
+    def _apply(self, fn, *args, **kwargs):
+        self = original_apply(self, fn, *args, **kwargs)
+        for m in self.modules():
+            if isinstance(m, c3k2_sw_class):
+                m._sync_memory_format()
+        return self
+
+    _apply._shiftwise_patched = True
+    _apply.__doc__ = original_apply.__doc__
+    tasks.BaseModel._apply = _apply
+
 
 def apply_shiftwise_patch():
     """Apply monkey patch to inject ShiftWise modules into ultralytics.
@@ -12,6 +55,8 @@ def apply_shiftwise_patch():
     2. Injects them into ultralytics.nn.modules namespace
     3. Patches parse_model to recognize C3k2_SW
     4. Registers modules in base_modules and repeat_modules
+    5. Extends BaseModel.fuse to fold BatchNorm inside ShiftWise modules
+    6. Extends BaseModel._apply to keep C3k2_SW in channels_last on CUDA
     
     Usage:
         from yolo12_shiftwise import apply_shiftwise_patch
@@ -19,9 +64,15 @@ def apply_shiftwise_patch():
         
         from ultralytics import YOLO
         model = YOLO("yolo12s_shiftwise.yaml")
+    
+    Once every step has succeeded, calling it again in the same process is a no-op; a call
+    after a partial failure retries the failed steps.
     """
+    global _PATCH_APPLIED
+    if _PATCH_APPLIED:
+        return
     
-    # 1. 導入 ShiftWise 模組
+    # 1. 導入 ShiftWise 模組（C3k2_SW 的定義會一併快取 ultralytics 的 Conv/C2f/C3k）
     from ..modules import ShiftWiseConv, BottleneckSW, C3k2_SW
     
     # 2. 注入到 ultralytics.nn.modules 命名空間
@@ -40,8 +91,6 @@ def apply_shiftwise_patch():
         else:
             ult_modules.__all__ = ['ShiftWiseConv', 'BottleneckSW', 'C3k2_SW']
         
-        print("✅ ShiftWise modules injected into ultralytics.nn.modules")
-        
     except ImportError as e:
         raise ImportError(f"Failed to import ultralytics.nn.modules: {e}. Make sure ultralytics is installed.")
     
@@ -60,65 +109,61 @@ def apply_shiftwise_patch():
                 block_all.extend(['ShiftWiseConv', 'BottleneckSW', 'C3k2_SW'])
                 ult_block.__all__ = tuple(block_all)
         
-        print("✅ ShiftWise modules injected into ultralytics.nn.modules.block")
-        
     except ImportError as e:
         raise ImportError(f"Failed to import ultralytics.nn.modules.block: {e}")
     
     # 4. 更新 tasks.py 的 imports 和 globals
     try:
         from ultralytics.nn import tasks
-        from ..modules.block import get_c3k2_sw_class
-        
-        # 獲取實際的 C3k2_SW 類（不是代理類）
-        # 這樣 parse_model 中的 m is C3k2_SW 才能正確工作
-        actual_c3k2_sw_class = get_c3k2_sw_class()
         
         # 確保 C3k2_SW 在 globals 中（parse_model 使用 globals()[m] 來獲取模組）
         tasks_globals = tasks.__dict__
-        # 使用實際的類而不是代理類，這樣 m is C3k2_SW 才能正確工作
-        tasks_globals['C3k2_SW'] = actual_c3k2_sw_class
+        tasks_globals['C3k2_SW'] = C3k2_SW
         if 'BottleneckSW' not in tasks_globals:
             tasks_globals['BottleneckSW'] = BottleneckSW
         if 'ShiftWiseConv' not in tasks_globals:
             tasks_globals['ShiftWiseConv'] = ShiftWiseConv
         
-        # 5. 確保 C3k2_SW 在 base_modules 和 repeat_modules 中
-        if hasattr(tasks, 'base_modules'):
-            # base_modules 是 frozenset，需要創建新的
-            base_modules_set = set(tasks.base_modules) if isinstance(tasks.base_modules, (set, frozenset)) else set()
-            # 使用實際的類而不是代理類
-            base_modules_set.add(actual_c3k2_sw_class)
-            tasks.base_modules = frozenset(base_modules_set)
-        
-        if hasattr(tasks, 'repeat_modules'):
-            repeat_modules_set = set(tasks.repeat_modules) if isinstance(tasks.repeat_modules, (set, frozenset)) else set()
-            # 使用實際的類而不是代理類
-            repeat_modules_set.add(actual_c3k2_sw_class)
-            tasks.repeat_modules = frozenset(repeat_modules_set)
-        
-        # 6. 確保 parse_model 中的 C3k2_SW 參數處理邏輯正確
-        # parse_model 中已經有處理 C3k2_SW 的邏輯（在 ultralytics 的 tasks.py 中）
-        # 現在使用實際的類，所以 m is C3k2_SW 應該能正確工作
-        
-        print("✅ C3k2_SW registered in base_modules and repeat_modules")
-        print("✅ parse_model ready to support C3k2_SW")
+    except ImportError as e:
+        raise ImportError(f"Failed to import ultralytics.nn.tasks: {e}")
+    
+    # 以下各步驟獨立 try/except：任一步失敗只記錄警告，不會跳過其餘步驟；
+    # 各步驟都可重複執行，所以只要有一步失敗就不設定 _PATCH_APPLIED，讓下次呼叫重試
+    ok = True
+    
+    # 5. 確保 C3k2_SW 在 base_modules 和 repeat_modules 中
+    # parse_model 中已經有處理 C3k2_SW 的邏輯（在 ultralytics 的 tasks.py 中），
+    # C3k2_SW 是真正的 C2f 子類，所以 m is C3k2_SW 能正確工作
+    try:
+        # frozenset 的 | 直接回傳新的 frozenset；已註冊過則不重建
+        for name in ('base_modules', 'repeat_modules'):
+            registered = getattr(tasks, name, None)
+            if isinstance(registered, (set, frozenset)) and C3k2_SW not in registered:
+                setattr(tasks, name, frozenset(registered) | {C3k2_SW})
         
     except Exception as e:
-        import traceback
-        print(f"⚠️  Warning: Failed to patch parse_model: {e}")
-        traceback.print_exc()
-        print("   You may need to manually register C3k2_SW in your YAML config")
+        LOGGER.warning(
+            "Failed to register C3k2_SW in base_modules/repeat_modules: %s. "
+            "You may need to manually register C3k2_SW in your YAML config",
+            e,
+            exc_info=True,
+        )
+        ok = False
     
-    print("\n" + "="*60)
-    print("✅ ShiftWise patch applied successfully!")
-    print("="*60)
-    print("\nYou can now use ShiftWise modules in your YAML config:")
-    print("  - C3k2_SW: C3k2 block with ShiftWise convolution")
-    print("  - BottleneckSW: Bottleneck with ShiftWise convolution")
-    print("  - ShiftWiseConv: Direct ShiftWise convolution layer")
-    print("\nExample YAML:")
-    print("  backbone:")
-    print("    - [-1, 2, C3k2_SW, [256, False, 0.25]]")
-    print("="*60 + "\n")
-
+    # 6. 讓 model.fuse()（推論前 AutoBackend 會呼叫）一併融合 ShiftWise 模組內的 BN
+    try:
+        _patch_fuse(tasks, (C3k2_SW, BottleneckSW, ShiftWiseConv))
+    except Exception as e:
+        LOGGER.warning("Failed to patch BaseModel.fuse: %s", e, exc_info=True)
+        ok = False
+    
+    # 7. model.to("cuda") 等裝置/型別轉換後，讓大核卷積使用 cuDNN 偏好的 NHWC layout
+    try:
+        _patch_apply(tasks, C3k2_SW)
+    except Exception as e:
+        LOGGER.warning("Failed to patch BaseModel._apply: %s", e, exc_info=True)
+        ok = False
+    
+    if ok:
+        _PATCH_APPLIED = True
+        LOGGER.info("ShiftWise patch applied: ShiftWiseConv, BottleneckSW and C3k2_SW are available in YAML configs")